@@ -5,7 +5,7 @@ import subprocess
 import os
 
 # This list contains symbols that _might_ be exported for some platforms
-PLATFORM_SYMBOLS = [
+PLATFORM_SYMBOLS = frozenset([
     '__bss_end__',
     '__bss_start__',
     '__bss_start',
@@ -15,7 +15,7 @@ PLATFORM_SYMBOLS = [
     '_end',
     '_fini',
     '_init',
-]
+])
 
 
 def get_symbols(nm, lib):
@@ -23,11 +23,25 @@ def get_symbols(nm, lib):
     List all the (non platform-specific) symbols exported by the library
     '''
     symbols = []
-    output = subprocess.check_output([nm, '--format=bsd', '-D', '--defined-only', lib],
-                                     stderr=open(os.devnull, 'w')).decode("ascii")
-    for line in output.splitlines():
-        (_, _, symbol_name) = line.split()
-        symbols.append(symbol_name)
+    cmd = [nm, '--format=posix', '--no-demangle', '--defined-only', '-D', lib]
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(cmd,
+                                stdout=subprocess.PIPE,
+                                stderr=devnull,
+                                bufsize=1 << 16)
+        try:
+            # Consume nm's output as it is produced rather than buffering the
+            # whole symbol table in memory first.
+            # Line format (posix):
+            # name type value size
+            for line in proc.stdout:
+                symbol_name = line.decode("ascii").partition(' ')[0]
+                symbols.append(symbol_name)
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
     return symbols
 
 
@@ -48,16 +62,16 @@ def main():
     args = parser.parse_args()
 
     lib_symbols = get_symbols(args.nm, args.lib)
-    mandatory_symbols = []
-    optional_symbols = []
+    mandatory_symbols = set()
+    optional_symbols = set()
     with open(args.symbols_file) as symbols_file:
         qualifier_optional = '(optional)'
-        for line in symbols_file.readlines():
+        for line in symbols_file.read().splitlines():
 
             # Strip comments
-            line = line.split('#')[0]
-            line = line.strip()
-            if not line:
+            line = line.partition('#')[0]
+            fields = line.split()
+            if not fields:
                 continue
 
             # Line format:
@@ -65,14 +79,13 @@ def main():
             qualifier = None
             symbol = None
 
-            fields = line.split()
             if len(fields) == 1:
                 symbol = fields[0]
             elif len(fields) == 2:
                 qualifier = fields[0]
                 symbol = fields[1]
             else:
-                print(args.symbols_file + ': invalid format: ' + line)
+                print(args.symbols_file + ': invalid format: ' + line.strip())
                 exit(1)
 
             # The only supported qualifier is 'optional', which means the
@@ -82,23 +95,13 @@ def main():
                 exit(1)
 
             if qualifier == qualifier_optional:
-                optional_symbols.append(symbol)
+                optional_symbols.add(symbol)
             else:
-                mandatory_symbols.append(symbol)
-
-    unknown_symbols = []
-    for symbol in lib_symbols:
-        if symbol in mandatory_symbols:
-            continue
-        if symbol in optional_symbols:
-            continue
-        if symbol in PLATFORM_SYMBOLS:
-            continue
-        unknown_symbols.append(symbol)
-
-    missing_symbols = [
-        sym for sym in mandatory_symbols if sym not in lib_symbols
-    ]
+                mandatory_symbols.add(symbol)
+
+    lib_symbols = set(lib_symbols)
+    unknown_symbols = sorted(lib_symbols - mandatory_symbols - optional_symbols - PLATFORM_SYMBOLS)
+    missing_symbols = sorted(mandatory_symbols - lib_symbols)
 
     for symbol in unknown_symbols:
         print(args.lib + ': unknown symbol exported: ' + symbol)
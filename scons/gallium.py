@@ -31,7 +31,10 @@ Frontend-tool for Gallium3D architecture.
 
 from __future__ import print_function
 
+import atexit
 import distutils.version
+import hashlib
+import json
 import os
 import os.path
 import re
@@ -45,6 +48,31 @@ import SCons.Builder
 import SCons.Scanner
 
 
+# Scons version string has consistently been in this format:
+# MajorVersion.MinorVersion.Patch[.alpha/beta.yyyymmdd]
+# so this formula should cover all versions regardless of type
+# stable, alpha or beta.
+# For simplicity alpha and beta flags are removed.
+scons_version = tuple(map(int, SCons.__version__.split('.')[:3]))
+
+# Host system, as needed to determine whether we are cross compiling
+_host_system = host_platform.system()
+_host_platform = _host_system.lower()
+if _host_platform.startswith('cygwin'):
+    _host_platform = 'cygwin'
+_host_machine = os.environ.get('PROCESSOR_ARCHITEW6432', os.environ.get('PROCESSOR_ARCHITECTURE', host_platform.machine()))
+_host_machine = {
+    'x86': 'x86',
+    'i386': 'x86',
+    'i486': 'x86',
+    'i586': 'x86',
+    'i686': 'x86',
+    'ppc' : 'ppc',
+    'AMD64': 'x86_64',
+    'x86_64': 'x86_64',
+}.get(_host_machine, 'generic')
+
+
 def symlink(target, source, env):
     target = str(target[0])
     source = str(source[0])
@@ -69,16 +97,18 @@ def install_shared_library(env, sources, version = ()):
         libs = env.FindIxes(sources, 'LIBPREFIX', 'LIBSUFFIX')
         targets += install(env, libs, 'lib')
     else:
+        target_dir = os.path.join(install_dir, 'lib')
+        # Version suffixes, from the full version down to none
+        suffixes = [version[:i] for i in range(len(version), -1, -1)]
+        action = SCons.Action.Action(symlink, "  Symlinking $TARGET ...")
         for source in sources:
-            target_dir =  os.path.join(install_dir, 'lib')
-            target_name = '.'.join((str(source),) + version)
+            src_str = str(source)
+            target_name = '.'.join((src_str,) + suffixes[0])
             last = env.InstallAs(os.path.join(target_dir, target_name), source)
             targets += last
-            while len(version):
-                version = version[:-1]
-                target_name = '.'.join((str(source),) + version)
-                action = SCons.Action.Action(symlink, "  Symlinking $TARGET ...")
-                last = env.Command(os.path.join(target_dir, target_name), last, action) 
+            for suffix in suffixes[1:]:
+                target_name = '.'.join((src_str,) + suffix)
+                last = env.Command(os.path.join(target_dir, target_name), last, action)
                 targets += last
     return targets
 
@@ -107,6 +137,15 @@ def unit_test(env, test_name, program_target, args=None):
 
 
 def num_jobs():
+    try:
+        # os.cpu_count() may return None when undetermined
+        jobs = os.cpu_count()
+        if jobs:
+            return jobs
+    except AttributeError:
+        # Python 2
+        pass
+
     try:
         return int(os.environ['NUMBER_OF_PROCESSORS'])
     except (ValueError, KeyError):
@@ -117,60 +156,197 @@ def num_jobs():
     except (ValueError, OSError, AttributeError):
         pass
 
-    try:
-        return int(os.popen2("sysctl -n hw.ncpu")[1].read())
-    except ValueError:
-        pass
-
     return 1
 
 
-def check_cc(env, cc, expr, cpp_opt = '-E'):
-    # Invoke C-preprocessor to determine whether the specified expression is
-    # true or not.
-
-    sys.stdout.write('Checking for %s ... ' % cc)
+# Feature probe results, keyed by configure directory
+_probe_caches = {}
+_probe_cache_name = 'feature-cache.json'
 
-    source = tempfile.NamedTemporaryFile(suffix='.c', delete=False)
-    source.write('#if !(%s)\n#error\n#endif\n' % expr)
-    source.close()
+def _save_probe_caches():
+    for configure_dir, cache in _probe_caches.items():
+        if not os.path.isdir(configure_dir):
+            os.makedirs(configure_dir)
+        with open(os.path.join(configure_dir, _probe_cache_name), 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
 
-    # sys.stderr.write('%r %s %s\n' % (env['CC'], cpp_opt, source.name));
+def _load_probe_cache(env):
+    configure_dir = env.Dir(env['CONFIGUREDIR']).abspath
+    try:
+        return _probe_caches[configure_dir]
+    except KeyError:
+        pass
 
-    pipe = SCons.Action._subproc(env, env.Split(env['CC']) + [cpp_opt, source.name],
-                                 stdin = 'devnull',
-                                 stderr = 'devnull',
-                                 stdout = 'devnull')
-    result = pipe.wait() == 0
+    if not _probe_caches:
+        atexit.register(_save_probe_caches)
+    try:
+        with open(os.path.join(configure_dir, _probe_cache_name)) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    _probe_caches[configure_dir] = cache
+    return cache
+
+def _probe_key(env, name, args):
+    cc_path = env.WhereIs(env.Split(env['CC'])[0]) or env['CC']
+    try:
+        cc_mtime = os.path.getmtime(cc_path)
+    except OSError:
+        cc_mtime = None
+    key = repr((
+        env['CC'],
+        cc_path,
+        cc_mtime,
+        env.subst('$CCFLAGS $CFLAGS $CPPFLAGS $CPPPATH $CPPDEFINES'),
+        env.subst('$LINKFLAGS $LIBS $LIBPATH'),
+        env['ENV'].get('PATH'),
+        name,
+        args,
+    ))
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return hashlib.md5(key).hexdigest()
+
+def cached_probe(probe):
+    '''Memoize the result of a feature probe across SCons runs.
+
+    Results are stored in the configure directory, keyed by the compiler
+    (command, path and modification time), the compile and link flags, and
+    the probe arguments, so that warm runs don't have to spawn any processes.
+    Run scons with --config=force to redo the probes and refresh the cache,
+    or delete feature-cache.json from the configure directory.'''
+
+    def wrapper(context, *args):
+        # Probes take either an environment or a configure context
+        env = getattr(context, 'env', context)
+        cache = _load_probe_cache(env)
+        key = _probe_key(env, probe.__name__, args)
+        if key not in cache or env.GetOption('config') == 'force':
+            result = probe(context, *args)
+            cache[key] = result
+            return result
+
+        result = cache[key]
+        if args:
+            # Otherwise the caller reports the result
+            what = args[0]
+            if isinstance(what, (list, tuple)):
+                what = ', '.join(what)
+            sys.stdout.write('Checking for %s ... (cached) %s\n' % (what, ['no', 'yes'][int(bool(result))]))
+        return result
+
+    wrapper.__name__ = probe.__name__
+    wrapper.__doc__ = probe.__doc__
+    return wrapper
+
+
+# Compiler families, and the expressions on their pre-defined macros that
+# identify them
+compiler_probes = [
+    ('msvc', 'MSVC', 'defined(_MSC_VER)'),
+    ('gcc_compat', 'GCC', 'defined(__GNUC__)'),
+    ('clang', 'Clang', '__clang__'),
+]
+
+@cached_probe
+def probe_compiler(env):
+    """Determine which compiler families CC belongs to.
+
+    All the expressions in compiler_probes are evaluated with a single
+    invocation of the C-preprocessor, which emits a marker for every
+    expression that is true.  Returns a dict mapping each probe name to
+    whether its expression held."""
+
+    source = ''.join(['#if %s\nmesa_compiler_%s\n#endif\n' % (expr, name)
+                      for name, _, expr in compiler_probes]).encode()
+
+    if _host_system in ('Windows', 'SunOS'):
+        # MSVC's cl and Sun Studio's cc can't read the source from stdin
+        source_file = tempfile.NamedTemporaryFile(suffix='.c', delete=False)
+        source_file.write(source)
+        source_file.close()
+        args = [source_file.name]
+        stdin = 'devnull'
+        source = None
+    else:
+        source_file = None
+        args = ['-x', 'c', '-']
+        stdin = subprocess.PIPE
 
-    os.unlink(source.name)
+    try:
+        pipe = SCons.Action._subproc(env, env.Split(env['CC']) + ['-E'] + args,
+                                     stdin = stdin,
+                                     stderr = 'devnull',
+                                     stdout = subprocess.PIPE)
+        output = pipe.communicate(source)[0]
+        succeeded = pipe.wait() == 0
+    finally:
+        if source_file is not None:
+            os.unlink(source_file.name)
+
+    result = {}
+    for name, _, _ in compiler_probes:
+        result[name] = succeeded and ('mesa_compiler_%s' % name).encode() in output
+    return result
 
-    sys.stdout.write(' %s\n' % ['no', 'yes'][int(bool(result))])
+# Headers and functions whose presence is known in advance for a target
+# platform, so that they don't need to be probed.  Only list what holds for
+# every supported libc and OS version of the platform.
+_prior_probes = {
+    'linux': {
+        'endian.h': True,
+        'sys/shm.h': True,
+    },
+    'darwin': {
+        'xlocale.h': True,
+        'endian.h': False,
+        'sys/shm.h': True,
+        'strtod_l': True,
+        'strtof_l': True,
+        'random_r': False,
+    },
+    'freebsd': {
+        'xlocale.h': True,
+        'sys/shm.h': True,
+    },
+}
+
+def _prior_probe(conf, name):
+    """Return the known result for the named probe, or None if unknown."""
+
+    result = _prior_probes.get(conf.env['platform'], {}).get(name)
+    if result is not None:
+        sys.stdout.write('Checking for %s ... (known) %s\n' % (name, ['no', 'yes'][int(result)]))
     return result
 
-def check_header(env, header):
+@cached_probe
+def check_header(conf, header):
     '''Check if the header exist'''
 
-    conf = SCons.Script.Configure(env)
+    have_header = _prior_probe(conf, header)
+    if have_header is not None:
+        return have_header
+
     have_header = False
 
     if conf.CheckHeader(header):
         have_header = True
 
-    env = conf.Finish()
     return have_header
 
-def check_functions(env, functions):
+@cached_probe
+def check_functions(conf, functions):
     '''Check if all of the functions exist'''
 
-    conf = SCons.Script.Configure(env)
     have_functions = True
 
     for function in functions:
-        if not conf.CheckFunc(function):
+        have_function = _prior_probe(conf, function)
+        if have_function is None:
+            have_function = conf.CheckFunc(function)
+        if not have_function:
             have_functions = False
 
-    env = conf.Finish()
     return have_functions
 
 def check_prog(env, prog):
@@ -207,49 +383,16 @@ def generate(env):
     if 'LDFLAGS' in os.environ:
         env['LINKFLAGS'] += SCons.Util.CLVar(os.environ['LDFLAGS'])
 
-    # Detect gcc/clang not by executable name, but through pre-defined macros
-    # as autoconf does, to avoid drawing wrong conclusions when using tools
-    # that overrice CC/CXX like scan-build.
-    env['gcc_compat'] = 0
-    env['clang'] = 0
-    env['msvc'] = 0
-    if host_platform.system() == 'Windows':
-        env['msvc'] = check_cc(env, 'MSVC', 'defined(_MSC_VER)', '/E')
-    if not env['msvc']:
-        env['gcc_compat'] = check_cc(env, 'GCC', 'defined(__GNUC__)')
-    env['clang'] = check_cc(env, 'Clang', '__clang__')
-    env['gcc'] = env['gcc_compat'] and not env['clang']
-    env['suncc'] = env['platform'] == 'sunos' and os.path.basename(env['CC']) == 'cc'
-    env['icc'] = 'icc' == os.path.basename(env['CC'])
-
     # shortcuts
     machine = env['machine']
     platform = env['platform']
     x86 = env['machine'] == 'x86'
     ppc = env['machine'] == 'ppc'
-    gcc_compat = env['gcc_compat']
-    msvc = env['msvc']
-    suncc = env['suncc']
-    icc = env['icc']
 
     # Determine whether we are cross compiling; in particular, whether we need
     # to compile code generators with a different compiler as the target code.
-    hosthost_platform = host_platform.system().lower()
-    if hosthost_platform.startswith('cygwin'):
-        hosthost_platform = 'cygwin'
-    host_machine = os.environ.get('PROCESSOR_ARCHITEW6432', os.environ.get('PROCESSOR_ARCHITECTURE', host_platform.machine()))
-    host_machine = {
-        'x86': 'x86',
-        'i386': 'x86',
-        'i486': 'x86',
-        'i586': 'x86',
-        'i686': 'x86',
-        'ppc' : 'ppc',
-        'AMD64': 'x86_64',
-        'x86_64': 'x86_64',
-    }.get(host_machine, 'generic')
-    env['crosscompile'] = platform != hosthost_platform
-    if machine == 'x86_64' and host_machine != 'x86_64':
+    env['crosscompile'] = platform != _host_platform
+    if machine == 'x86_64' and _host_machine != 'x86_64':
         env['crosscompile'] = True
     env['hostonly'] = False
 
@@ -304,6 +447,30 @@ def generate(env):
     env['CONFIGUREDIR'] = os.path.join(build_dir, 'conf')
     env['CONFIGURELOG'] = os.path.join(os.path.abspath(build_dir), 'config.log')
 
+    # Detect gcc/clang not by executable name, but through pre-defined macros
+    # as autoconf does, to avoid drawing wrong conclusions when using tools
+    # that overrice CC/CXX like scan-build.
+    compilers = probe_compiler(env)
+    env['gcc_compat'] = 0
+    env['clang'] = 0
+    env['msvc'] = 0
+    for name, cc, _ in compiler_probes:
+        if name == 'msvc' and _host_system != 'Windows':
+            continue
+        if name == 'gcc_compat' and env['msvc']:
+            continue
+        env[name] = compilers[name]
+        sys.stdout.write('Checking for %s ...  %s\n' % (cc, ['no', 'yes'][int(bool(env[name]))]))
+    env['gcc'] = env['gcc_compat'] and not env['clang']
+    env['suncc'] = env['platform'] == 'sunos' and os.path.basename(env['CC']) == 'cc'
+    env['icc'] = 'icc' == os.path.basename(env['CC'])
+
+    # shortcuts
+    gcc_compat = env['gcc_compat']
+    msvc = env['msvc']
+    suncc = env['suncc']
+    icc = env['icc']
+
     # Parallel build
     if env.GetOption('num_jobs') <= 1:
         env.SetOption('num_jobs', num_jobs())
@@ -311,16 +478,7 @@ def generate(env):
     # Speed up dependency checking.  See
     # - https://github.com/SCons/scons/wiki/GoFastButton
     # - https://bugs.freedesktop.org/show_bug.cgi?id=109443
-
-    # Scons version string has consistently been in this format:
-    # MajorVersion.MinorVersion.Patch[.alpha/beta.yyyymmdd]
-    # so this formula should cover all versions regardless of type
-    # stable, alpha or beta.
-    # For simplicity alpha and beta flags are removed.
-
-    scons_version = distutils.version.StrictVersion('.'.join(SCons.__version__.split('.')[:3]))
-    if scons_version < distutils.version.StrictVersion('3.0.2') or \
-       scons_version > distutils.version.StrictVersion('3.0.4'):
+    if not (3, 0, 2) <= scons_version <= (3, 0, 4):
         env.Decider('MD5-timestamp')
     env.SetOption('max_drift', 60)
 
@@ -360,24 +518,30 @@ def generate(env):
                 'GLX_INDIRECT_RENDERING',
             ]
 
-        if check_header(env, 'xlocale.h'):
+        # Share a single configure context among all the checks.  Note that
+        # Finish() may return a clone of env, which we don't want to use.
+        conf = env.Configure()
+
+        if check_header(conf, 'xlocale.h'):
             cppdefines += ['HAVE_XLOCALE_H']
 
-        if check_header(env, 'endian.h'):
+        if check_header(conf, 'endian.h'):
             cppdefines += ['HAVE_ENDIAN_H']
 
-        if check_functions(env, ['strtod_l', 'strtof_l']):
+        if check_functions(conf, ['strtod_l', 'strtof_l']):
             cppdefines += ['HAVE_STRTOD_L']
 
-        if check_functions(env, ['random_r']):
+        if check_functions(conf, ['random_r']):
             cppdefines += ['HAVE_RANDOM_R']
 
-        if check_functions(env, ['timespec_get']):
+        if check_functions(conf, ['timespec_get']):
             cppdefines += ['HAVE_TIMESPEC_GET']
 
-        if check_header(env, 'sys/shm.h'):
+        if check_header(conf, 'sys/shm.h'):
             cppdefines += ['HAVE_SYS_SHM_H']
 
+        conf.Finish()
+
     if platform == 'windows':
         cppdefines += [
             'WIN32',
@@ -663,7 +827,7 @@ def generate(env):
         # breaking stuff, as MSVC doesn't fully support C99.  There's also no
         # way to premptively include stdint.
         env.Append(CCFLAGS = ['-FIinttypes.h'])
-    if host_platform.system() == 'Windows':
+    if _host_system == 'Windows':
         # Prefer winflexbison binaries, as not only they are easier to install
         # (no additional dependencies), but also better Windows support.
         if check_prog(env, 'win_flex'):
@@ -675,7 +839,7 @@ def generate(env):
             ])
 
     env.Tool('yacc')
-    if host_platform.system() == 'Windows':
+    if _host_system == 'Windows':
         if check_prog(env, 'win_bison'):
             env["YACC"] = 'win_bison'
 